@@ -2,13 +2,31 @@
 
 from flask import Flask
 
+try:
+    import uvloop
+except ImportError:  # not available on Windows
+    uvloop = None
+
 from shabda.dj import Dj
 from . import web
 
 
+class Shabda(Flask):
+    """Flask application running async views on uvloop when available"""
+
+    def async_to_sync(self, func):
+        if uvloop is None:
+            return super().async_to_sync(func)
+
+        def run(*args, **kwargs):
+            return uvloop.run(func(*args, **kwargs))
+
+        return run
+
+
 def create_app():
     """Create the Flask application"""
-    app = Flask(__name__)
+    app = Shabda(__name__)
 
     app.register_blueprint(web.bp)
 
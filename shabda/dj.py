@@ -7,6 +7,7 @@ import asyncio
 import os
 import random
 import urllib
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 
 import freesound
@@ -27,11 +28,18 @@ class Dj:
     client = None
     samples_path = ""
     speech_samples_path = ""
+    executor = None
+    tts_client = None
 
-    def __init__(self, config_path="", samples_path="", speech_samples_path=""):
+    def __init__(
+        self, config_path="", samples_path="", speech_samples_path="", max_workers=None
+    ):
         self.client = Client(config_path)
         self.samples_path = samples_path
         self.speech_samples_path = speech_samples_path
+        # Shared by all event loops, so blocking calls are not capped by a
+        # small per-loop default executor
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
 
     def parse_definition(self, definition):
         """Parse a pack definition"""
@@ -106,7 +114,7 @@ class Dj:
         if os.path.exists(filepath):
             return True
 
-        client = texttospeech.TextToSpeechClient()
+        client = self.text_to_speech_client()
         synthesis_input = texttospeech.SynthesisInput(text=word.replace("_", " "))
 
         if gender == "f":
@@ -131,8 +139,15 @@ class Dj:
             audio_encoding=texttospeech.AudioEncoding.LINEAR16,
             pitch=max(-20.0, min(20.0, pitch)),
         )
-        response = client.synthesize_speech(
-            input=synthesis_input, voice=voice, audio_config=audio_config
+        loop = asyncio.get_event_loop()
+        response = await loop.run_in_executor(
+            self.executor,
+            partial(
+                client.synthesize_speech,
+                input=synthesis_input,
+                voice=voice,
+                audio_config=audio_config,
+            ),
         )
         with open(filepath, "wb") as out:
             out.write(response.audio_content)
@@ -147,6 +162,12 @@ class Dj:
         sampleset.saveconfig()
         return True
 
+    def text_to_speech_client(self):
+        """Return a Text-to-Speech client, reusing its connection across calls"""
+        if self.tts_client is None:
+            self.tts_client = texttospeech.TextToSpeechClient()
+        return self.tts_client
+
     async def fetch(self, word, num, licenses):
         """Fetch a collection of samples"""
         mastersound = None
@@ -231,7 +252,7 @@ class Dj:
             print("")
             loop = asyncio.get_event_loop()
             results = await loop.run_in_executor(
-                None,
+                self.executor,
                 partial(
                     self.client.text_search,
                     query=word,
@@ -280,7 +301,9 @@ class Dj:
 
             print("Dowloading " + word_dir + " sample #" + str(sample_num) + "...")
             loop = asyncio.get_event_loop()
-            await loop.run_in_executor(None, ssound.retrieve, word_dir, source_name)
+            await loop.run_in_executor(
+                self.executor, ssound.retrieve, word_dir, source_name
+            )
 
             sound = pydub.AudioSegment.from_file(source_path)
             sound = sound.set_frame_rate(44100)
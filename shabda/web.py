@@ -1,22 +1,32 @@
 """Shabda web routes"""
 
 import asyncio
-import json
+import contextlib
+import io
+import mimetypes
 import os
-import tempfile
-from urllib.parse import urlparse
-from zipfile import ZipFile
-
+import re
+import threading
+import unicodedata
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from types import MappingProxyType
+from urllib.parse import quote
+from zipfile import ZIP_STORED, ZipFile, ZipInfo
+
+import orjson
 from flask import (
     Blueprint,
-    after_this_request,
-    jsonify,
+    Response,
+    current_app,
     render_template,
     request,
-    send_file,
     send_from_directory,
+    stream_with_context,
 )
-from werkzeug.exceptions import BadRequest, HTTPException
+from werkzeug.exceptions import BadRequest, HTTPException, NotFound
+from werkzeug.security import safe_join
 
 from shabda.dj import Dj
 
@@ -25,9 +35,79 @@ SHABDA_PATH = os.path.expanduser("~/.shabda/")
 SAMPLES_PATH = "samples/"
 SPEECH_SAMPLE_PATH = "speech_samples/"
 
+# Resolved once, they do not change while serving
+SAMPLES_ABSPATH = os.path.abspath(SAMPLES_PATH)
+SPEECH_SAMPLE_ABSPATH = os.path.abspath(SPEECH_SAMPLE_PATH)
+ASSETS_ABSPATH = os.path.abspath(os.path.join(os.path.dirname(__file__), "../assets/"))
+
+# Maximum number of words fetched or spoken at once for a single request
+MAX_CONCURRENCY = int(os.environ.get("SHABDA_MAX_CONCURRENCY", "8"))
+
+# Pitch suffix of generated speech variants, e.g. "_p+2.0"
+PITCHED = re.compile(r"_p[+-]\d")
+
+ZIP_READ_THREADS = 4
+ZIP_PREFETCH = 8
+# Files up to this size are read whole, larger ones are copied in chunks of it
+ZIP_CHUNK_SIZE = 1024 * 1024
+
 bp = Blueprint("web", __name__, url_prefix="/")
 
-dj = Dj(SHABDA_PATH, SAMPLES_PATH, SPEECH_SAMPLE_PATH)
+dj = Dj(
+    SHABDA_PATH,
+    SAMPLES_PATH,
+    SPEECH_SAMPLE_PATH,
+    max_workers=int(os.environ.get("SHABDA_MAX_THREADS", "64")),
+)
+
+
+class _ListCache:  # pylint:disable=too-few-public-methods
+    """In-memory LRU index of sample listings, saving sample set reads.
+
+    Entries are checked against the modification time of the sample set
+    config, so samples added by any worker are picked up on the next call.
+    """
+
+    def __init__(self, engine, maxsize=2048):
+        self.engine = engine
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __call__(self, word, max_number=None, **filters):
+        """List sounds like Dj.list, filtered by licenses, gender, language..."""
+        filters = {name: value for name, value in filters.items() if value is not None}
+        if "licenses" in filters:
+            filters["licenses"] = tuple(filters["licenses"])
+        key = (word, max_number, tuple(sorted(filters.items())))
+        version = self._version(word, filters.get("soundtype"))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(key)
+                return entry[1]
+        sounds = self.engine.list(word, max_number, **filters)
+        with self._lock:
+            self._entries[key] = (version, sounds)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return sounds
+
+    def _version(self, word, soundtype):
+        """Return the modification time and size of a sample set config"""
+        if soundtype == "tts":
+            path = self.engine.speech_samples_path
+        else:
+            path = self.engine.samples_path
+        try:
+            stat = os.stat(os.path.join(path, word, "config"))
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+
+_list_cached = _ListCache(dj)
 
 
 @bp.route("/")
@@ -43,26 +123,11 @@ async def pack(definition):
     if licenses is not None:
         licenses = licenses.split(",")
 
-    tasks = []
-    try:
-        words = dj.parse_definition(definition)
-    except ValueError as ex:
-        raise BadRequest(ex) from ex
-
-    for word, number in words.items():
-        if number is None:
-            number = 1
-        tasks.append(fetch_one(word, number, licenses))
-    results = await asyncio.gather(*tasks)
-
-    global_status = "empty"
-    for status in results:
-        if status is True:
-            global_status = "ok"
+    words, results = await _fetch_pack(definition, licenses)
 
     return jsonify(
         {
-            "status": global_status,
+            "status": _status(results),
             "definition": clean_definition(words),
         }
     )
@@ -74,72 +139,36 @@ async def pack_json(definition):
     complete = request.args.get("complete", False, type=bool)
     licenses = request.args.get("licenses", None)
     strudel = request.args.get("strudel", False, type=bool)
+    stream = request.args.get("stream", False, type=bool)
     if licenses is not None:
         licenses = licenses.split(",")
 
-    await pack(definition)
+    words, _ = await _fetch_pack(definition, licenses)
 
-    url = urlparse(request.base_url)
-    scheme = request.headers.get("X-Forwarded-Proto", url.scheme)
-    base = scheme + "://" + url.hostname
-    if url.port:
-        base += ":" + str(url.port)
-    script_name = request.environ.get("SCRIPT_NAME", "")
-    base += script_name + "/"
-    try:
-        words = dj.parse_definition(definition)
-    except ValueError as ex:
-        raise BadRequest(ex) from ex
+    base = _request_base()
+    word_samples = _pack_samples(words, licenses)
     if strudel:
-        reslist = {"_base": base}
-    else:
-        reslist = []
-    for word, number in words.items():
-        samples = dj.list(word, number, licenses=licenses)
-        sample_num = 0
-        for sound in samples:
-            if strudel:
-                if word not in reslist:
-                    reslist[word] = []
-                reslist[word].append(sound.file)
-            else:
-                sound_data = {
-                    "url": sound.file,
-                    "type": "audio",
-                    "bank": word,
-                    "n": sample_num,
-                }
-                if complete:
-                    sound_data["licensename"] = sound.licensename
-                    sound_data["original_url"] = sound.url
-                    sound_data["author"] = sound.username
-                reslist.append(sound_data)
-                sample_num += 1
-
-    return jsonify(reslist)
+        return jsonify(_strudel_map(base, word_samples))
+    records = _records(word_samples, complete)
+    if stream:
+        return ndjson_response(records)
+    return jsonify(list(records))
 
 
 @bp.route("/<definition>.zip")
 def pack_zip(definition):
     """Download a zip archive"""
     try:
-        words = dj.parse_definition(definition)
+        words = _parse_definition(definition)
     except ValueError as ex:
         raise BadRequest(ex) from ex
     definition = clean_definition(words)
-    tmpfile = tempfile.gettempdir() + "/" + definition + ".zip"
-    with ZipFile(tmpfile, "w") as zipfile:
-        for word, number in words.items():
-            samples = dj.list(word, number)
-            for sample in samples:
-                zipfile.write(sample.file, sample.file[len("samples/") :])
-
-    @after_this_request
-    def remove_file(response):
-        os.remove(tmpfile)
-        return response
-
-    return send_file(tmpfile, as_attachment=True)
+    files = []
+    for word, number in words.items():
+        samples = _list_cached(word, number)
+        for sample in samples:
+            files.append((sample.file, sample.file[len("samples/") :]))
+    return zip_response(definition, files)
 
 
 @bp.route("/speech/<definition>.zip")
@@ -147,22 +176,15 @@ def speech_zip(definition):
     """Download a zip archive"""
     definition = definition.replace(" ", "_")
     try:
-        words = dj.parse_definition(definition)
+        words = _parse_definition(definition)
     except ValueError as ex:
         raise BadRequest(ex) from ex
-    tmpfile = tempfile.gettempdir() + "/" + definition + ".zip"
-    with ZipFile(tmpfile, "w") as zipfile:
-        for word, number in words.items():
-            samples = dj.list(word, number, soundtype="tts")
-            for sample in samples:
-                zipfile.write(sample.file, sample.file[len("speech_samples/") :])
-
-    @after_this_request
-    def remove_file(response):
-        os.remove(tmpfile)
-        return response
-
-    return send_file(tmpfile, as_attachment=True)
+    files = []
+    for word, number in words.items():
+        samples = _list_cached(word, number, soundtype="tts")
+        for sample in samples:
+            files.append((sample.file, sample.file[len("speech_samples/") :]))
+    return zip_response(clean_definition(words), files)
 
 
 @bp.route("/speech/<definition>")
@@ -172,23 +194,11 @@ async def speech(definition):
     language = request.args.get("language", "en-GB")
     pitch = request.args.get("pitch", 0.0, type=float)
 
-    definition = definition.replace(" ", "_")
-    try:
-        words = dj.parse_definition(definition)
-    except ValueError as ex:
-        raise BadRequest(ex) from ex
-    tasks = []
-    for word in words:
-        tasks.append(speak_one(word, language, gender, pitch))
-    results = await asyncio.gather(*tasks)
-    global_status = "empty"
-    for status in results:
-        if status is True:
-            global_status = "ok"
+    words, results = await _do_speech(definition, language, gender, pitch)
 
     return jsonify(
         {
-            "status": global_status,
+            "status": _status(results),
             "definition": clean_definition(words),
         }
     )
@@ -198,79 +208,40 @@ async def speech(definition):
 async def speech_json(definition):
     """Download a reslist definition"""
     strudel = request.args.get("strudel", False, type=bool)
+    stream = request.args.get("stream", False, type=bool)
     gender = request.args.get("gender", "f")
     language = request.args.get("language", "en-GB")
     pitch = request.args.get("pitch", 0.0, type=float)
-    definition = definition.replace(" ", "_")
 
-    await speech(definition)
+    words, _ = await _do_speech(definition, language, gender, pitch)
 
-    url = urlparse(request.base_url)
-    scheme = request.headers.get("X-Forwarded-Proto", url.scheme)
-    base = scheme + "://" + url.hostname
-    if url.port:
-        base += ":" + str(url.port)
-    # Include SCRIPT_NAME prefix (e.g. /shabda when mounted under FastAPI)
-    script_name = request.environ.get("SCRIPT_NAME", "")
-    base += script_name + "/"
-    try:
-        words = dj.parse_definition(definition)
-    except ValueError as ex:
-        raise BadRequest(ex) from ex
+    base = _request_base()
+    word_samples = _speech_samples(words, gender, language, pitch)
     if strudel:
-        reslist = {"_base": base}
-    else:
-        reslist = []
-    for word in words:
-        samples = dj.list(word, gender=gender, language=language, soundtype="tts")
-        # Filter to only the sample matching the requested pitch
-        if pitch != 0.0:
-            pitch_suffix = f"_p{pitch:+.1f}"
-            samples = [s for s in samples if pitch_suffix in s.file]
-        else:
-            # When no pitch, exclude any pitched variants
-            samples = [
-                s for s in samples if "_p+" not in s.file and "_p-" not in s.file
-            ]
-        sample_key = word
-        sample_num = 0
-        for sound in samples:
-            if strudel:
-                if sample_key not in reslist:
-                    reslist[sample_key] = []
-                reslist[sample_key].append(sound.file)
-            else:
-                sound_data = {
-                    "url": sound.file,
-                    "type": "audio",
-                    "bank": sample_key,
-                    "n": sample_num,
-                }
-                reslist.append(sound_data)
-                sample_num += 1
-
-    return jsonify(reslist)
+        return jsonify(_strudel_map(base, word_samples))
+    records = _records(word_samples)
+    if stream:
+        return ndjson_response(records)
+    return jsonify(list(records))
 
 
 @bp.route("/speech_samples/<path:path>")
 @bp.route("/speech/speech_samples/<path:path>")
 def serve_sample(path):
     """Serve a sample"""
-    return send_from_directory(
-        os.path.abspath(SPEECH_SAMPLE_PATH), path, as_attachment=False
-    )
+    return send_sample(SPEECH_SAMPLE_ABSPATH, "/_internal_speech_samples/", path)
 
 
 @bp.route("/samples/<path:path>")
 def serve_speech_sample(path):
     """Serve a sample"""
-    return send_from_directory(os.path.abspath(SAMPLES_PATH), path, as_attachment=False)
+    return send_sample(SAMPLES_ABSPATH, "/_internal_samples/", path)
 
 
 @bp.route("/assets/<path:path>")
 def static(path):
     """Serve a static asset"""
-    return send_from_directory("../assets/", path, as_attachment=False)
+    return send_from_directory(ASSETS_ABSPATH, path, as_attachment=False)
 
 
 @bp.errorhandler(HTTPException)
@@ -279,17 +250,19 @@ def handle_exception(exception):
     # start with the correct headers and status code from the error
     response = exception.get_response()
     # replace the body with JSON
-    response.data = json.dumps(
-        {
-            "code": exception.code,
-            "name": exception.name,
-            "description": exception.description,
-        }
+    response.data = _error_body(
+        exception.code, exception.name, str(exception.description)
     )
     response.content_type = "application/json"
     return response
 
 
+@lru_cache(maxsize=64)
+def _error_body(code, name, description):
+    """Serialize an error, the same few errors (e.g. 404) being served over"""
+    return orjson.dumps({"code": code, "name": name, "description": description})
+
+
 @bp.after_request
 def cors_after(response):
     """Add CORS headers to response"""
@@ -297,19 +270,246 @@ def cors_after(response):
     return response
 
 
-async def speak_one(word, language, gender, pitch=0.0):
+@lru_cache(maxsize=4096)
+def _parse_definition(definition):
+    """Parse a definition, memoized as clients keep requesting the same packs"""
+    # Read-only view, so callers cannot alter the cached entry
+    return MappingProxyType(dj.parse_definition(definition))
+
+
+def _request_base():
+    """Return the base URL samples are served from for this request"""
+    scheme = request.headers.get("X-Forwarded-Proto", request.scheme)
+    # Include SCRIPT_NAME prefix (e.g. /shabda when mounted under FastAPI)
+    script_name = request.environ.get("SCRIPT_NAME", "")
+    # The host already includes the port, if any
+    return scheme + "://" + request.host + script_name + "/"
+
+
+async def _fetch_pack(definition, licenses):
+    """Parse a pack definition and fetch its samples"""
+    try:
+        words = _parse_definition(definition)
+    except ValueError as ex:
+        raise BadRequest(ex) from ex
+
+    # Created per request: Flask runs each async view on its own event loop
+    semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+    tasks = []
+    for word, number in words.items():
+        if number is None:
+            number = 1
+        tasks.append(fetch_one(word, number, licenses, semaphore))
+    results = await asyncio.gather(*tasks)
+    return words, results
+
+
+async def _do_speech(definition, language, gender, pitch):
+    """Parse a speech definition and generate its samples"""
+    definition = definition.replace(" ", "_")
+    try:
+        words = _parse_definition(definition)
+    except ValueError as ex:
+        raise BadRequest(ex) from ex
+
+    semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+    tasks = []
+    for word in words:
+        tasks.append(speak_one(word, language, gender, pitch, semaphore))
+    results = await asyncio.gather(*tasks)
+    return words, results
+
+
+def _status(results):
+    """Return "ok" if any sample set was retrieved, "empty" otherwise"""
+    return "ok" if any(result is True for result in results) else "empty"
+
+
+def _pack_samples(words, licenses):
+    """Yield (word, samples) for the words of a pack that have samples"""
+    for word, number in words.items():
+        samples = _list_cached(word, number, licenses=licenses)
+        if samples:
+            yield word, samples
+
+
+def _speech_samples(words, gender, language, pitch):
+    """Yield (word, samples) for spoken words, keeping the requested pitch"""
+    for word in words:
+        samples = _list_cached(word, gender=gender, language=language, soundtype="tts")
+        # Filter to only the sample matching the requested pitch
+        if pitch != 0.0:
+            pitch_suffix = f"_p{pitch:+.1f}"
+            samples = [s for s in samples if pitch_suffix in s.file]
+        else:
+            # When no pitch, exclude any pitched variants
+            samples = [s for s in samples if not PITCHED.search(s.file)]
+        if samples:
+            yield word, samples
+
+
+def _strudel_map(base, word_samples):
+    """Build a strudel sample map"""
+    reslist = {"_base": base}
+    for word, samples in word_samples:
+        reslist[word] = [sound.file for sound in samples]
+    return reslist
+
+
+def _records(word_samples, complete=False):
+    """Yield reslist records, one per sample"""
+    for word, samples in word_samples:
+        if complete:
+            yield from (
+                {
+                    "url": sound.file,
+                    "type": "audio",
+                    "bank": word,
+                    "n": sample_num,
+                    "licensename": sound.licensename,
+                    "original_url": sound.url,
+                    "author": sound.username,
+                }
+                for sample_num, sound in enumerate(samples)
+            )
+        else:
+            yield from (
+                {"url": sound.file, "type": "audio", "bank": word, "n": sample_num}
+                for sample_num, sound in enumerate(samples)
+            )
+
+
+async def speak_one(word, language, gender, pitch=0.0, semaphore=None):
     """Speak a word"""
-    return await dj.speak(word, language, gender, pitch)
+    async with semaphore or contextlib.nullcontext():
+        return await dj.speak(word, language, gender, pitch)
 
 
-async def fetch_one(word, number, licenses):
+async def fetch_one(word, number, licenses, semaphore=None):
     """Fetch a single sample set"""
-    return await dj.fetch(word, number, licenses)
+    async with semaphore or contextlib.nullcontext():
+        return await dj.fetch(word, number, licenses)
+
+
+def ndjson_response(records):
+    """Stream records as newline delimited JSON while they are produced"""
+
+    def generate():
+        for record in records:
+            yield orjson.dumps(record) + b"\n"
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+
+def jsonify(obj):
+    """Build a JSON response, serialized with orjson"""
+    return current_app.response_class(orjson.dumps(obj), mimetype="application/json")
 
 
 def clean_definition(words):
     """reconstruct the definition without unwanted chars"""
-    definition = []
-    for word, number in words.items():
-        definition.append(word + (":" + str(number) if number else ""))
-    return ",".join(definition)
+    if not any(words.values()):
+        # Common case of a definition without sample numbers
+        return ",".join(words)
+    return ",".join(
+        f"{word}:{number}" if number else word for word, number in words.items()
+    )
+
+
+def send_sample(directory, internal_location, path):
+    """Send a sample file, or let nginx send it when proxied with X-Accel: 1"""
+    if request.headers.get("X-Accel") == "1":
+        if safe_join(directory, path) is None:
+            raise NotFound()
+        return Response(
+            headers={"X-Accel-Redirect": internal_location + quote(path)},
+            mimetype=mimetypes.guess_type(path)[0] or "application/octet-stream",
+        )
+    return send_from_directory(directory, path, as_attachment=False)
+
+
+def _read_file(path):
+    """Read a small file whole, larger ones are left to be streamed"""
+    if os.path.getsize(path) > ZIP_CHUNK_SIZE:
+        return None
+    with open(path, "rb") as file:
+        return file.read()
+
+
+def _write_member(zipfile, buffer, path, arcname, data):
+    """Add a file to a streamed zip archive, yielding the bytes produced"""
+    # Keep the file modification time and mode, as ZipFile.write does
+    zinfo = ZipInfo.from_file(path, arcname)
+    zinfo.compress_type = ZIP_STORED
+    if data is not None:
+        zipfile.writestr(zinfo, data)
+        yield buffer.drain()
+        return
+    with zipfile.open(zinfo, "w", force_zip64=True) as dest, open(path, "rb") as src:
+        while chunk := src.read(ZIP_CHUNK_SIZE):
+            dest.write(chunk)
+            yield buffer.drain()
+
+
+class StreamingBytesIO(io.RawIOBase):
+    """Write-only, non-seekable buffer that hands out what has been written"""
+
+    def __init__(self):
+        super().__init__()
+        self._buffer = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._buffer += b
+        return len(b)
+
+    def drain(self):
+        """Return the buffered bytes and empty the buffer"""
+        chunk = bytes(self._buffer)
+        self._buffer.clear()
+        return chunk
+
+
+def zip_response(definition, files):
+    """Stream a zip archive of (path, arcname) files as it is built"""
+
+    def generate():
+        buffer = StreamingBytesIO()
+        # Audio is already compressed, storing is the fastest option
+        with ThreadPoolExecutor(max_workers=ZIP_READ_THREADS) as executor, ZipFile(
+            buffer, "w", ZIP_STORED
+        ) as zipfile:
+            # Read the next few files in the background while one is written
+            pending = deque()
+            for path, arcname in files:
+                pending.append((path, arcname, executor.submit(_read_file, path)))
+                if len(pending) < ZIP_PREFETCH:
+                    continue
+                path, arcname, data = pending.popleft()
+                yield from _write_member(zipfile, buffer, path, arcname, data.result())
+            for path, arcname, data in pending:
+                yield from _write_member(zipfile, buffer, path, arcname, data.result())
+        # Central directory, written when the archive is closed
+        yield buffer.drain()
+
+    response = Response(stream_with_context(generate()), mimetype="application/zip")
+    _set_attachment(response, definition + ".zip")
+    return response
+
+
+def _set_attachment(response, filename):
+    """Set an attachment Content-Disposition header, as send_file does"""
+    options = {"filename": filename}
+    try:
+        filename.encode("ascii")
+    except UnicodeEncodeError:
+        # ASCII fallback for old clients, and the real name as RFC 5987 value
+        options["filename"] = (
+            unicodedata.normalize("NFKD", filename)
+            .encode("ascii", "ignore")
+            .decode("ascii")
+        )
+        options["filename*"] = "UTF-8''" + quote(filename, safe="!#$&+^`|~")
+    response.headers.set("Content-Disposition", "attachment", **options)
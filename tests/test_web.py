@@ -0,0 +1,254 @@
+"""Test web routes helpers"""
+
+import io
+import json
+import os
+from zipfile import ZipFile, ZipInfo
+
+import pytest
+
+from shabda import create_app, web
+from shabda.web import _ListCache, dj, send_sample, zip_response
+
+
+@pytest.fixture(name="client")
+def fixture_client(mocker):
+    """Test client with Freesound and Text-to-Speech calls faked"""
+    mocker.patch.object(dj, "fetch", return_value=True)
+    mocker.patch.object(dj, "speak", return_value=True)
+    mocker.patch.object(web, "_list_cached", _ListCache(dj))
+    return create_app().test_client()
+
+
+def build_zip(filename, files):
+    """Build a streamed zip response and collect its content"""
+    app = create_app()
+    with app.test_request_context():
+        response = zip_response(filename, files)
+        return response, response.get_data()
+
+
+def test_zip_response(fake_filesystem):
+    """Stream a zip archive of small and large files"""
+    small = b"RIFF" + b"\x01" * 1000
+    large = b"RIFF" + b"\x02" * (3 * 1024 * 1024)
+    fake_filesystem.create_file("samples/kick/kick_0.wav", contents=small)
+    fake_filesystem.create_file("samples/kick/kick_1.wav", contents=large)
+    fake_filesystem.create_file("samples/snare/snare_0.wav", contents=small)
+
+    _, data = build_zip(
+        "kick:2,snare",
+        [
+            ("samples/kick/kick_0.wav", "kick/kick_0.wav"),
+            ("samples/kick/kick_1.wav", "kick/kick_1.wav"),
+            ("samples/snare/snare_0.wav", "snare/snare_0.wav"),
+        ],
+    )
+
+    with ZipFile(io.BytesIO(data)) as archive:
+        assert archive.testzip() is None
+        assert [(info.filename, info.file_size) for info in archive.infolist()] == [
+            ("kick/kick_0.wav", len(small)),
+            ("kick/kick_1.wav", len(large)),
+            ("snare/snare_0.wav", len(small)),
+        ]
+        assert archive.read("kick/kick_1.wav") == large
+
+
+def test_zip_response_metadata(fake_filesystem):
+    """Keep file modification times and modes in the archive"""
+    for name, size in (("small.wav", 10), ("large.wav", 2 * 1024 * 1024)):
+        fake_filesystem.create_file("samples/kick/" + name, contents=b"\0" * size)
+        os.chmod("samples/kick/" + name, 0o644)
+        os.utime("samples/kick/" + name, (1700000000, 1700000000))
+
+    _, data = build_zip(
+        "kick",
+        [
+            ("samples/kick/small.wav", "kick/small.wav"),
+            ("samples/kick/large.wav", "kick/large.wav"),
+        ],
+    )
+
+    expected = ZipInfo.from_file("samples/kick/small.wav").date_time
+    with ZipFile(io.BytesIO(data)) as archive:
+        for info in archive.infolist():
+            assert info.date_time == expected
+            assert info.external_attr >> 16 & 0o777 == 0o644
+
+
+def test_zip_response_filename():
+    """Name the zip attachment like send_file does"""
+    response, _ = build_zip("kick:2,snare", [])
+    assert (
+        response.headers["Content-Disposition"]
+        == 'attachment; filename="kick:2,snare.zip"'
+    )
+
+    response, _ = build_zip("привет", [])
+    assert response.headers["Content-Disposition"] == (
+        "attachment; filename=.zip; "
+        "filename*=UTF-8''%D0%BF%D1%80%D0%B8%D0%B2%D0%B5%D1%82.zip"
+    )
+
+
+def test_send_sample_x_accel():
+    """Let nginx send samples when proxied with X-Accel"""
+    app = create_app()
+    with app.test_request_context(headers={"X-Accel": "1"}):
+        response = send_sample("/srv/samples", "/_internal_samples/", "kick/0.wav")
+    assert response.headers["X-Accel-Redirect"] == "/_internal_samples/kick/0.wav"
+    assert response.mimetype in ("audio/wav", "audio/x-wav")
+
+
+def sample_config(*files):
+    """Build a sample set config listing the given files"""
+    sounds = [
+        {
+            "id": i,
+            "url": "https://freesound.org/s/" + str(i),
+            "username": "bob",
+            "license": "cc0",
+            "file": file,
+            "gender": "f",
+            "language": "en-GB",
+        }
+        for i, file in enumerate(files)
+    ]
+    return json.dumps({"master": 1, "sounds": sounds})
+
+
+def test_list_cache(fake_filesystem):
+    """Cached listings follow changes of the sample set config"""
+    config = fake_filesystem.create_file(
+        "samples/kick/config", contents=sample_config("samples/kick/kick_0.wav")
+    )
+    list_cached = _ListCache(dj)
+    assert [s.file for s in list_cached("kick")] == ["samples/kick/kick_0.wav"]
+    assert list_cached("kick") is list_cached("kick")
+
+    # Another worker adds a sample
+    config.set_contents(
+        sample_config("samples/kick/kick_0.wav", "samples/kick/kick_1.wav")
+    )
+    assert [s.file for s in list_cached("kick")] == [
+        "samples/kick/kick_0.wav",
+        "samples/kick/kick_1.wav",
+    ]
+    assert len(list_cached("kick", 1)) == 1
+
+    # Same size, different modification time
+    config.set_contents(
+        sample_config("samples/kick/kick_2.wav", "samples/kick/kick_3.wav")
+    )
+    os.utime("samples/kick/config", ns=(1, 1))
+    assert [s.file for s in list_cached("kick", licenses=["cc0"])] == [
+        "samples/kick/kick_2.wav",
+        "samples/kick/kick_3.wav",
+    ]
+    assert not list_cached("kick", licenses=["by"])
+
+
+# The client fixture must come first: Flask's test client reads the
+# Werkzeug version from installed package metadata, which the fake
+# filesystem hides.
+def test_pack_json(client, fake_filesystem):
+    """List the samples of a pack"""
+    fake_filesystem.create_file(
+        "samples/kick/config",
+        contents=sample_config("samples/kick/kick_0.wav", "samples/kick/kick_1.wav"),
+    )
+    fake_filesystem.create_file("samples/snare/config", contents=sample_config())
+
+    response = client.get("/kick:2,snare.json")
+    assert response.json == [
+        {"url": "samples/kick/kick_0.wav", "type": "audio", "bank": "kick", "n": 0},
+        {"url": "samples/kick/kick_1.wav", "type": "audio", "bank": "kick", "n": 1},
+    ]
+
+    response = client.get("/kick:1.json?complete=1")
+    assert response.json == [
+        {
+            "url": "samples/kick/kick_0.wav",
+            "type": "audio",
+            "bank": "kick",
+            "n": 0,
+            "licensename": "cc0",
+            "original_url": "https://freesound.org/s/0",
+            "author": "bob",
+        }
+    ]
+
+
+def test_pack_json_strudel(client, fake_filesystem):
+    """Map the samples of a pack for strudel"""
+    fake_filesystem.create_file(
+        "samples/kick/config", contents=sample_config("samples/kick/kick_0.wav")
+    )
+    fake_filesystem.create_file("samples/snare/config", contents=sample_config())
+
+    response = client.get(
+        "/kick,snare.json?strudel=1", base_url="http://localhost/shabda/"
+    )
+    assert response.json == {
+        "_base": "http://localhost/shabda/",
+        "kick": ["samples/kick/kick_0.wav"],
+    }
+
+
+def test_pack_json_stream(client, fake_filesystem):
+    """Stream the samples of a pack as NDJSON"""
+    fake_filesystem.create_file(
+        "samples/kick/config",
+        contents=sample_config("samples/kick/kick_0.wav", "samples/kick/kick_1.wav"),
+    )
+    fake_filesystem.create_file(
+        "samples/snare/config", contents=sample_config("samples/snare/snare_0.wav")
+    )
+
+    response = client.get("/kick:2,snare.json?stream=1")
+    assert response.mimetype == "application/x-ndjson"
+    lines = response.get_data().splitlines()
+    assert [json.loads(line) for line in lines] == [
+        {"url": "samples/kick/kick_0.wav", "type": "audio", "bank": "kick", "n": 0},
+        {"url": "samples/kick/kick_1.wav", "type": "audio", "bank": "kick", "n": 1},
+        {"url": "samples/snare/snare_0.wav", "type": "audio", "bank": "snare", "n": 0},
+    ]
+
+
+def test_speech_json(client, fake_filesystem):
+    """List spoken words, keeping only the requested pitch"""
+    fake_filesystem.create_file(
+        "speech_samples/hello/config",
+        contents=sample_config(
+            "speech_samples/hello/hello_en-GB_f.wav",
+            "speech_samples/hello/hello_en-GB_f_p+2.0.wav",
+            "speech_samples/hello/hello_en-GB_f_p-3.5.wav",
+        ),
+    )
+
+    response = client.get("/speech/hello.json")
+    assert response.json == [
+        {
+            "url": "speech_samples/hello/hello_en-GB_f.wav",
+            "type": "audio",
+            "bank": "hello",
+            "n": 0,
+        }
+    ]
+
+    response = client.get("/speech/hello.json?pitch=-3.5&strudel=1")
+    assert response.json == {
+        "_base": "http://localhost/",
+        "hello": ["speech_samples/hello/hello_en-GB_f_p-3.5.wav"],
+    }
+
+    response = client.get("/speech/hello.json?pitch=2&stream=1")
+    assert response.mimetype == "application/x-ndjson"
+    assert response.get_data().splitlines() == [
+        b'{"url":"speech_samples/hello/hello_en-GB_f_p+2.0.wav",'
+        b'"type":"audio","bank":"hello","n":0}'
+    ]
+
+    response = client.get("/speech/hello.json?pitch=1")
+    assert response.json == []